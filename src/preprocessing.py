@@ -1,7 +1,41 @@
 import os
+import glob
+import soundfile
 import subprocess
-import math
-from pydub import AudioSegment
+import tempfile
+
+_scratch_dir = None
+
+def get_scratch_dir():
+    """
+    Retorna um diretório de scratch para WAVs intermediários, preferindo
+    tmpfs (/dev/shm) quando disponível.
+
+    WAV é PCM não comprimido (~30 MB/min a 16 kHz mono) e o pipeline o
+    relê entre os estágios; mantê-lo em RAM elimina a banda de disco.
+    Cai para um tempdir comum quando /dev/shm não existe ou não é gravável.
+    """
+    global _scratch_dir
+    if _scratch_dir is None:
+        shm_dir = os.path.join("/dev/shm", "xvoice_proc")
+        try:
+            os.makedirs(shm_dir, exist_ok=True)
+            if os.access(shm_dir, os.W_OK):
+                _scratch_dir = shm_dir
+            else:
+                _scratch_dir = tempfile.mkdtemp(prefix="xvoice_proc_")
+        except OSError:
+            _scratch_dir = tempfile.mkdtemp(prefix="xvoice_proc_")
+        print(f"[INFO] Using scratch directory: {_scratch_dir}")
+    return _scratch_dir
+
+def discard_scratch_file(path):
+    """Remove um WAV intermediário caso ele esteja no diretório de scratch."""
+    if _scratch_dir and path and os.path.dirname(path) == _scratch_dir:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
 
 def normalize_audio(input_path, output_path, sample_rate=16000, channels=1, noise_reduction=True):
     """
@@ -20,29 +54,22 @@ def normalize_audio(input_path, output_path, sample_rate=16000, channels=1, nois
     try:
         print(f"[INFO] Normalizing audio: {input_path}")
 
-        # **1. Ajuste de Formato e Normalização**
-        ffmpeg_cmd = [
-            "ffmpeg", "-y", "-i", input_path, "-ar", str(sample_rate), "-ac", str(channels),
-            "-b:a", "128k", "-threads", "4", "-filter:a", "loudnorm", output_path
-        ]
-
-        subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-        
+        # **Filtros encadeados em uma única passada de FFmpeg**
+        # (um decode, um resample, um encode — sem WAV intermediário)
         if noise_reduction:
-            print(f"[INFO] Applying noise reduction: {output_path}")
-
-            # **2. Aplicar Filtros High-Pass e Low-Pass para Remover Ruído**
-            noise_reduction_cmd = [
-                "ffmpeg", "-y", "-i", output_path,
-                "-af", "highpass=f=200, lowpass=f=3000",
-                "-threads", "4",
-                output_path.replace(".wav", "_denoised.wav")
-            ]
+            audio_filter = "highpass=f=200,lowpass=f=3000,loudnorm=I=-16:TP=-1.5:LRA=11"
+        else:
+            audio_filter = "loudnorm=I=-16:TP=-1.5:LRA=11"
 
-            subprocess.run(noise_reduction_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        ffmpeg_cmd = [
+            "ffmpeg", "-y", "-loglevel", "error", "-nostats", "-i", input_path,
+            "-ar", str(sample_rate), "-ac", str(channels),
+            "-b:a", "128k", "-threads", "0", "-af", audio_filter, output_path
+        ]
 
-            # Substituir pelo arquivo denoised
-            os.replace(output_path.replace(".wav", "_denoised.wav"), output_path)
+        # DEVNULL em vez de PIPE: o log do ffmpeg não fica acumulando em
+        # memória nem bloqueia o encode quando o buffer do pipe enche
+        subprocess.run(ffmpeg_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
 
         print(f"[SUCCESS] Normalized and denoised audio saved: {output_path}")
 
@@ -52,7 +79,11 @@ def normalize_audio(input_path, output_path, sample_rate=16000, channels=1, nois
 def split_audio(input_path, output_dir, max_duration=300):
     """
     Splits the audio file into smaller parts if it exceeds max_duration (in seconds).
-    
+
+    The transcription pipeline no longer splits: Whisper windows long audio
+    internally into 30-second mel chunks. This is kept only as a fallback for
+    multi-hour recordings where bounding per-call memory is still useful.
+
     Parameters:
     input_path (str): Path to the input .wav file.
     output_dir (str): Directory where the split files will be saved.
@@ -62,25 +93,35 @@ def split_audio(input_path, output_dir, max_duration=300):
     list: List of file paths to the split audio files.
     """
     print(f"[INFO] Checking if audio needs to be split: {input_path}")
-    
-    audio = AudioSegment.from_wav(input_path)
-    duration = len(audio) / 1000  # Convert to seconds
+
+    # soundfile.info lê apenas o header do WAV — sem fork de ffprobe
+    # e sem decodificar os samples
+    info = soundfile.info(input_path)
+    duration = info.frames / info.samplerate
 
     if duration <= max_duration:
         print("[INFO] Audio duration is within limits. No splitting needed.")
         return [input_path]
 
     os.makedirs(output_dir, exist_ok=True)
-    num_parts = math.ceil(duration / max_duration)
-    file_paths = []
-
-    for i in range(num_parts):
-        start_time = i * max_duration * 1000  # Convert to milliseconds
-        end_time = min((i + 1) * max_duration * 1000, len(audio))
-        part = audio[start_time:end_time]
-        part_filename = os.path.join(output_dir, f"{os.path.basename(input_path).replace('.wav', '')}_part{i+1}.wav")
-        part.export(part_filename, format="wav")
-        file_paths.append(part_filename)
+    prefix = os.path.basename(input_path).replace(".wav", "")
+    part_pattern = os.path.join(output_dir, f"{prefix}_part*.wav")
+
+    # Remove partes de execuções anteriores: o glob abaixo deve devolver
+    # exatamente o que esta invocação produziu, não sobras antigas
+    for stale_part in glob.glob(part_pattern):
+        os.remove(stale_part)
+
+    # Stream-copy dos frames PCM: sem re-decode e sem carregar o WAV na memória
+    segment_cmd = [
+        "ffmpeg", "-y", "-loglevel", "error", "-nostats", "-i", input_path, "-f", "segment",
+        "-segment_time", str(max_duration), "-c", "copy",
+        os.path.join(output_dir, f"{prefix}_part%03d.wav")
+    ]
+    subprocess.run(segment_cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+
+    file_paths = sorted(glob.glob(part_pattern))
+    for part_filename in file_paths:
         print(f"[SUCCESS] Created split file: {part_filename}")
 
     return file_paths
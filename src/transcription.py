@@ -1,38 +1,107 @@
 import os
-import whisper
-import torch
 import json
-import re
 import spacy
-import gc
+import soundfile
 import subprocess
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
-from src.preprocessing import split_audio
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from src.preprocessing import normalize_audio, get_scratch_dir, discard_scratch_file
 
 # Load spaCy model for text processing
 def load_spacy_model(model):
-    """Verifica e carrega o modelo do spaCy, instalando se necessário."""
+    """
+    Verifica e carrega o modelo do spaCy, instalando se necessário.
+
+    clean_transcription só precisa de limites de sentença e flags de
+    stopword, então todos os componentes que o modelo trouxer são
+    desabilitados e apenas o sentencizer (baseado em regras, ~100x mais
+    barato que o parser) roda em cada doc — independente do idioma do
+    modelo.
+    """
     try:
-        return spacy.load(model)
+        nlp = spacy.load(model)
     except OSError:
         print(f"[INFO] Installing spaCy model: {model}...")
         subprocess.run(["python", "-m", "spacy", "download", model])
-        return spacy.load(model)
+        nlp = spacy.load(model)
+
+    if nlp.pipe_names:
+        nlp.select_pipes(disable=nlp.pipe_names)
+    if "sentencizer" not in nlp.pipe_names:
+        nlp.add_pipe("sentencizer")
+
+    return nlp
+
+GPU_WORKERS = 2  # Concurrent decodes sharing the single GPU-resident model
+
+def load_whisper_model(model_size="medium", device="cuda", compute_type="int8_float16",
+                       num_workers=GPU_WORKERS):
+    """
+    Loads a faster-whisper model wrapped in a batched inference pipeline.
+
+    INT8 weight-only quantization on the decoder linears halves weight
+    bandwidth while activations stay in FP16, at essentially equal WER.
+    num_workers > 1 lets CTranslate2 run that many transcribe calls
+    concurrently against the same weights, so kernels from independent
+    requests interleave on the GPU without duplicating the model.
+
+    Parameters:
+    - model_size (str): Whisper model size (e.g., "small", "medium", "large-v3").
+    - device (str): Device to run inference on ("cuda" or "cpu").
+    - compute_type (str): CTranslate2 compute type (e.g., "int8_float16").
+    - num_workers (int): Concurrent transcribe calls the model accepts.
+
+    Returns:
+    - BatchedInferencePipeline: Model ready for batched transcription.
+    """
+    print(f"[INFO] Loading Whisper model: {model_size} ({device}, {compute_type})")
+    try:
+        model = WhisperModel(model_size, device=device, compute_type=compute_type,
+                             num_workers=num_workers)
+    except Exception as e:
+        if device == "cpu":
+            raise
+        # One-shot fallback at load time; the model stays pinned on whatever
+        # device it lands on for the rest of the run
+        print(f"[WARNING] Failed to load model on {device} ({e}), falling back to CPU...")
+        model = WhisperModel(model_size, device="cpu", compute_type="int8",
+                             num_workers=num_workers)
+    return BatchedInferencePipeline(model=model)
+
+def load_audio_array(file_path):
+    """
+    Decodes a normalized WAV once into the float32 mono array Whisper
+    consumes, skipping the decode that model.transcribe would otherwise
+    run internally on the path.
+
+    Returns None when the file is not already 16 kHz mono (the model's
+    internal decoder handles resampling in that case).
+    """
+    data, sample_rate = soundfile.read(file_path, dtype="float32")
+    if sample_rate != 16000 or data.ndim != 1:
+        return None
+    return data
 
 def transcribe_audio(file_path, model, nlp, language="pt", accumulated_time=0):
     """
-    Transcribes an audio file using Whisper and maintains accumulated timestamps.
+    Transcribes an audio file using batched Whisper inference and maintains
+    accumulated timestamps.
+
+    The whole file is fed to the model in one call; the VAD groups the audio
+    into uniform 30-second windows that are decoded together in batches, so
+    no manual splitting is required beforehand.
 
     Parameters:
     - file_path (str): Path to the audio file.
-    - model: Whisper model instance.
+    - model: BatchedInferencePipeline instance from load_whisper_model().
     - nlp: spaCy model instance for text processing.
     - language (str): Expected transcription language (default: "pt").
-    - accumulated_time (float): Running time from previous segments.
+    - accumulated_time (float): Running time from previous files.
 
     Returns:
-    - dict: Transcription results with timestamps.
-    - float: Updated accumulated time after processing the segment.
+    - List[dict]: Transcription results with timestamps, one per segment.
+    - float: Updated accumulated time after processing the file.
     """
     try:
         print(f"[INFO] Transcribing: {file_path}")
@@ -42,33 +111,51 @@ def transcribe_audio(file_path, model, nlp, language="pt", accumulated_time=0):
             print(f"[ERROR] Audio file not found: {file_path}")
             return None, accumulated_time
 
-        # Transcribe using Whisper
-        result = model.transcribe(file_path, language=language)
-
-        if "text" not in result:
+        # Normalized WAVs are already 16 kHz mono, so decode once here and
+        # hand the model the raw samples instead of re-decoding the path
+        audio = file_path
+        try:
+            decoded = load_audio_array(file_path)
+            if decoded is not None:
+                audio = decoded
+        except Exception:
+            pass  # fall back to the path; the model decodes it internally
+
+        # Transcribe using batched Whisper inference; greedy decoding
+        # (beam_size=1, single temperature, no cross-window conditioning)
+        # and VAD filtering keep the decoder work minimal
+        segments, info = model.transcribe(
+            audio, language=language, batch_size=16, beam_size=1,
+            temperature=0.0, condition_on_previous_text=False, vad_filter=True
+        )
+
+        transcriptions = []
+        raw_texts = []
+        last_end = 0.0
+        # segments is a generator; consuming it here runs the actual decode
+        for segment in segments:
+            # Segment timestamps come straight from the VAD windows, so the
+            # running offset only needs the previous files' total duration
+            formatted_timestamp = format_timestamp(accumulated_time + segment.start)
+            raw_texts.append(segment.text)
+
+            transcriptions.append({
+                "start": formatted_timestamp,
+                "text": "",
+                "duration": segment.end - segment.start,
+            })
+            last_end = segment.end
+
+        # Clean all segment texts in one nlp.pipe() pass
+        for transcription, cleaned_text in zip(transcriptions, clean_transcription_batch(raw_texts, nlp)):
+            transcription["text"] = cleaned_text
+
+        if not transcriptions:
             print(f"[WARNING] Whisper did not return text for {file_path}")
             return None, accumulated_time
 
-        # Extract timestamps
-        segments = result.get("segments", [])
-        if segments:
-            start_timestamp = accumulated_time  
-            segment_duration = float(segments[-1].get("end", 0))  
-            accumulated_time += segment_duration  # Update accumulated time
-
-            # Format timestamps
-            formatted_timestamp = format_timestamp(start_timestamp)
-            cleaned_text = clean_transcription(result["text"], nlp)  # ✅ Passando `nlp`
-
-            return {"start": formatted_timestamp, "text": cleaned_text, "duration": segment_duration}, accumulated_time
-
-    except RuntimeError as e:
-        if "CUDA out of memory" in str(e):
-            print("[WARNING] GPU memory issue, retrying on CPU...")
-            model.to("cpu")  
-            return transcribe_audio(file_path, model, nlp, language, accumulated_time)
-        else:
-            print(f"[ERROR] Failed to transcribe {file_path}: {e}")
+        accumulated_time += last_end
+        return transcriptions, accumulated_time
 
     except Exception as e:
         print(f"[ERROR] Failed to transcribe {file_path}: {e}")
@@ -77,114 +164,160 @@ def transcribe_audio(file_path, model, nlp, language="pt", accumulated_time=0):
 
 def transcribe_audio_batch(audio_files, model, nlp, language="pt", accumulated_time=0):
     """
-    Transcribes a batch of audio files using Whisper and maintains accumulated timestamps.
+    Transcribes a batch of audio files using batched Whisper inference and
+    maintains accumulated timestamps across files.
 
     Parameters:
     - audio_files (list): List of paths to audio files.
-    - model: Whisper model instance.
+    - model: BatchedInferencePipeline instance from load_whisper_model().
     - nlp: spaCy model instance for text processing.
     - language (str): Expected transcription language (default: "pt").
     - accumulated_time (float): Running time from previous segments.
 
     Returns:
     - List[dict]: List of transcription results with timestamps.
-    - float: Updated accumulated time after processing all segments.
+    - float: Updated accumulated time after processing all files.
     """
     transcriptions = []
-    
-    for file_path in audio_files:
-        print(f"[INFO] Transcribing: {file_path}")
-        
-        if not os.path.exists(file_path):
-            print(f"[ERROR] Audio file not found: {file_path}")
-            continue
-
-        try:
-            # Transcribe the segment
-            result = model.transcribe(file_path, language=language)
 
-            if "text" not in result:
-                print(f"[WARNING] Whisper did not return text for {file_path}")
-                continue
-
-            # Extract timestamps
-            segments = result.get("segments", [])
-            if segments:
-                start_timestamp = accumulated_time
-                segment_duration = float(segments[-1].get("end", 0))  
-                accumulated_time += segment_duration  # Update accumulated time
-
-                # Format timestamps
-                formatted_timestamp = format_timestamp(start_timestamp)
-                cleaned_text = clean_transcription(result["text"], nlp)  # ✅ Passando `nlp`
-
-                transcriptions.append({"start": formatted_timestamp, "text": cleaned_text, "duration": segment_duration})
-
-        except RuntimeError as e:
-            if "CUDA out of memory" in str(e):
-                print("[WARNING] GPU memory issue, retrying on CPU...")
-                model.to("cpu")
-                return transcribe_audio_batch(audio_files, model, nlp, language, accumulated_time)
-            else:
-                print(f"[ERROR] Failed to transcribe {file_path}: {e}")
+    for file_path in audio_files:
+        file_transcriptions, accumulated_time = transcribe_audio(
+            file_path, model, nlp, language=language, accumulated_time=accumulated_time
+        )
 
-        except Exception as e:
-            print(f"[ERROR] Failed to transcribe {file_path}: {e}")
+        if file_transcriptions:
+            transcriptions.extend(file_transcriptions)
 
     return transcriptions, accumulated_time
 
-def process_audio_file(file, input_dir, processed_dir, split_dir, transcription_dir, whisper_model, nlp, use_normalization):
+def process_audio_file(file, input_dir, processed_dir, transcription_dir, whisper_model, nlp, use_normalization):
     """
-    Processes an audio file, splitting it into segments and transcribing each segment sequentially.
+    Processes an audio file, transcribing the whole normalized WAV in one
+    batched inference call.
 
     Parameters:
     - file (str): The audio file name.
     - input_dir (str): Directory containing raw audio files.
     - processed_dir (str): Directory for processed audio files.
-    - split_dir (str): Directory for split audio segments.
     - transcription_dir (str): Directory to save transcriptions.
-    - whisper_model: Loaded Whisper model for transcription.
+    - whisper_model: BatchedInferencePipeline instance from load_whisper_model().
     - nlp: spaCy model instance for text processing.
     - use_normalization (bool): Whether to apply normalization and noise reduction.
     """
+    print(f"[INFO] Processing file: {file}")
+
+    try:
+        output_path = prepare_audio(file, input_dir, processed_dir, use_normalization)
+        try:
+            transcribe_and_save(file, output_path, transcription_dir, whisper_model, nlp)
+        finally:
+            discard_scratch_file(output_path)
+
+    except Exception as e:
+        print(f"[ERROR] Failed to process {file}: {e}")
+
+def prepare_audio(file, input_dir, processed_dir=None, use_normalization=True):
+    """
+    CPU stage: normalizes an audio file (optional) and returns the path of
+    the WAV ready for transcription.
+
+    When processed_dir is None the normalized WAV lands on the RAM-backed
+    scratch directory (tmpfs when available), so the bytes written here and
+    re-read by the transcription stage never touch real disk.
+    """
+    if processed_dir is None:
+        processed_dir = get_scratch_dir()
+
     input_path = os.path.join(input_dir, file)
     output_path = os.path.join(processed_dir, file.replace(".m4a", ".wav").replace(".mp3", ".wav"))
 
-    print(f"[INFO] Processing file: {file}")
+    if use_normalization:
+        print(f"[INFO] Normalizing and denoising audio: {input_path}")
+        normalize_audio(input_path, output_path, sample_rate=16000, channels=1, noise_reduction=True)
+    else:
+        print(f"[INFO] Skipping normalization. Using raw audio: {input_path}")
+        output_path = input_path
 
-    try:
-        # Step 1: Normalize audio and apply noise reduction (Optional)
-        if use_normalization:
-            print(f"[INFO] Normalizing and denoising audio: {input_path}")
-            normalize_audio(input_path, output_path, sample_rate=16000, channels=1, noise_reduction=True)
-        else:
-            print(f"[INFO] Skipping normalization. Using raw audio: {input_path}")
-            output_path = input_path  
+    return output_path
 
-        # Step 2: Split long audio files into smaller parts
-        split_files = split_audio(output_path, split_dir, max_duration=300)
+def transcribe_and_save(file, audio_path, transcription_dir, whisper_model, nlp):
+    """
+    GPU stage: transcribes a prepared WAV in one batched inference call
+    (the VAD chunks it into uniform 30-second windows internally) and
+    saves the final transcription.
+    """
+    transcriptions, _ = transcribe_audio(audio_path, whisper_model, nlp, language="pt")
 
-        # Step 3: Transcription using transcribe_audio_batch()
-        transcriptions, _ = transcribe_audio_batch(split_files, whisper_model, nlp, language="pt")
+    if isinstance(transcriptions, list):
+        txt_output = os.path.join(transcription_dir, os.path.basename(file).replace(".wav", ".txt"))
+        save_transcription(transcriptions, txt_output)
+    else:
+        print(f"[WARNING] Unexpected format in transcription output: {type(transcriptions)}")
 
-        # Step 4: Save the final transcription
-        if isinstance(transcriptions, list):
-            txt_output = os.path.join(transcription_dir, os.path.basename(file).replace(".wav", ".txt"))
-            save_transcription(transcriptions, txt_output)
-        else:
-            print(f"[WARNING] Unexpected format in transcription output: {type(transcriptions)}")
+def process_audio_files(files, input_dir, processed_dir, transcription_dir, whisper_model, nlp, use_normalization):
+    """
+    Processes a batch of audio files as a two-stage pipeline.
 
-        # Step 5: Remove intermediate split files
-        for split_file in split_files:
-            os.remove(split_file)
-            print(f"[INFO] Deleted intermediate split file: {split_file}")
+    Normalization (CPU/FFmpeg-bound) runs in a small thread pool while a
+    GPU executor feeds the Whisper model, so the model transcribes file N
+    while FFmpeg is already normalizing file N+1 — the ffmpeg time is
+    hidden behind the transcription of the previous file. The GPU executor
+    width matches the model's num_workers so the concurrent decodes
+    interleave on the GPU instead of queueing in Python.
 
-        # Step 6: Free GPU memory
-        torch.cuda.empty_cache()
-        gc.collect()
+    Normalization is only submitted as transcription slots free up, so at
+    most a handful of normalized WAVs exist at any moment — without this
+    backpressure a fast CPU stage would pile up one scratch WAV per input
+    file on the RAM-backed scratch dir.
 
-    except Exception as e:
-        print(f"[ERROR] Failed to process {file}: {e}")
+    Parameters mirror process_audio_file, with `files` as a list of names.
+    """
+    with ThreadPoolExecutor(max_workers=2) as cpu_pool, \
+         ThreadPoolExecutor(max_workers=GPU_WORKERS) as gpu_pool:
+
+        prepared = deque()     # (file, prepare future), at most cpu_workers deep
+        transcribed = deque()  # (file, audio_path, transcription future)
+
+        def hand_off_oldest():
+            """Waits for the oldest normalization and queues it on the GPU."""
+            file, prep_future = prepared.popleft()
+            try:
+                audio_path = prep_future.result()
+            except Exception as e:
+                print(f"[ERROR] Failed to process {file}: {e}")
+                return
+            transcribed.append(
+                (file, audio_path, gpu_pool.submit(transcribe_and_save, file, audio_path, transcription_dir, whisper_model, nlp))
+            )
+
+        def finish_oldest():
+            """Waits for the oldest transcription and discards its scratch WAV."""
+            file, audio_path, future = transcribed.popleft()
+            try:
+                future.result()
+            except Exception as e:
+                print(f"[ERROR] Failed to process {file}: {e}")
+            finally:
+                discard_scratch_file(audio_path)
+
+        for file in files:
+            prepared.append(
+                (file, cpu_pool.submit(prepare_audio, file, input_dir, processed_dir, use_normalization))
+            )
+
+            if len(prepared) < 2:
+                continue
+            hand_off_oldest()
+
+            # Backpressure: block here until a GPU slot frees before
+            # letting the CPU stage run ahead again
+            while len(transcribed) > GPU_WORKERS:
+                finish_oldest()
+
+        while prepared:
+            hand_off_oldest()
+        while transcribed:
+            finish_oldest()
 
 def format_time(seconds):
     """
@@ -220,23 +353,14 @@ def clean_transcription(text, nlp, sentence_segmentation=True, remove_stopwords=
             print("[ERROR] Transcription text is invalid!")
             return ""
 
-        # Remove espaços extras
-        text = re.sub(r"\s+", " ", text).strip()
+        # Remove espaços extras (str.split faz o colapso em uma única
+        # varredura em C, sem regex)
+        text = " ".join(text.split())
 
         # Processa com spaCy
         doc = nlp(text)
 
-        cleaned_sentences = []
-        for sent in doc.sents:
-            processed_text = sent.text.capitalize()
-
-            if remove_stopwords:
-                processed_text = " ".join([token.text for token in sent if not token.is_stop])
-                processed_text = processed_text.capitalize()
-
-            cleaned_sentences.append(processed_text)
-
-        formatted_text = " ".join(cleaned_sentences)
+        formatted_text = _format_doc(doc, remove_stopwords)
 
         print("[SUCCESS] Transcription cleaned and formatted.")
         return formatted_text
@@ -245,6 +369,44 @@ def clean_transcription(text, nlp, sentence_segmentation=True, remove_stopwords=
         print(f"[ERROR] Failed to clean transcription: {e}")
         return text
 
+def clean_transcription_batch(texts, nlp, remove_stopwords=False, batch_size=64):
+    """
+    Cleans a batch of transcribed texts in one nlp.pipe() pass.
+
+    Feeding all segment texts through nlp.pipe amortizes the per-doc
+    pipeline overhead instead of invoking nlp() once per segment.
+
+    Parameters:
+    texts (list of str): Raw transcribed texts.
+    nlp: Preloaded spaCy model.
+    remove_stopwords (bool): If True, removes common stopwords.
+    batch_size (int): Number of texts processed per pipe batch.
+
+    Returns:
+    list of str: Cleaned and formatted texts, aligned with the input.
+    """
+    try:
+        normalized = [" ".join(text.split()) if text and isinstance(text, str) else "" for text in texts]
+        return [_format_doc(doc, remove_stopwords) for doc in nlp.pipe(normalized, batch_size=batch_size)]
+
+    except Exception as e:
+        print(f"[ERROR] Failed to clean transcription batch: {e}")
+        return list(texts)
+
+def _format_doc(doc, remove_stopwords=False):
+    """Formata um doc já processado: capitaliza sentenças e filtra stopwords."""
+    cleaned_sentences = []
+    for sent in doc.sents:
+        processed_text = sent.text.capitalize()
+
+        if remove_stopwords:
+            processed_text = " ".join([token.text for token in sent if not token.is_stop])
+            processed_text = processed_text.capitalize()
+
+        cleaned_sentences.append(processed_text)
+
+    return " ".join(cleaned_sentences)
+
 def save_transcription(transcriptions, output_txt):
     """
     Saves the final transcription in a structured text format.
@@ -256,26 +418,32 @@ def save_transcription(transcriptions, output_txt):
     try:
         os.makedirs(os.path.dirname(output_txt), exist_ok=True)
 
+        lines = []
+        for transcription in _flatten(transcriptions):
+            if isinstance(transcription, dict):
+                start_time = transcription.get("start", "[00:00:00]")
+                text = transcription.get("text", "").strip()
+                lines.append(f"{start_time} {text}\n")
+            else:
+                print(f"[WARNING] Unexpected format in transcription output: {type(transcription)}")
+
+        # Um único write() em vez de uma syscall por linha
         with open(output_txt, "w", encoding="utf-8") as txt_file:
-            for transcription in transcriptions:
-                if isinstance(transcription, list):  # Se for uma lista dentro da lista, desfaz o aninhamento
-                    for sub_transcription in transcription:
-                        if isinstance(sub_transcription, dict):
-                            start_time = sub_transcription.get("start", "[00:00:00]")
-                            text = sub_transcription.get("text", "").strip()
-                            txt_file.write(f"{start_time} {text}\n")
-                elif isinstance(transcription, dict):  # Caso normal, processa normalmente
-                    start_time = transcription.get("start", "[00:00:00]")
-                    text = transcription.get("text", "").strip()
-                    txt_file.write(f"{start_time} {text}\n")
-                else:
-                    print(f"[WARNING] Unexpected format in transcription output: {type(transcription)}")
+            txt_file.write("".join(lines))
 
         print(f"[SUCCESS] Transcription saved: {output_txt}")
 
     except Exception as e:
         print(f"[ERROR] Failed to save transcription: {e}")
 
+def _flatten(transcriptions):
+    """Desfaz o aninhamento legado (listas dentro da lista) em um único gerador."""
+    for transcription in transcriptions:
+        if isinstance(transcription, list):
+            yield from transcription
+        else:
+            yield transcription
+
 def cleanup_directory(directory):
     """
     Removes all files in the specified directory.
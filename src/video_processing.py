@@ -1,27 +1,55 @@
 import os
-import subprocess
 import uuid
-import json
+import functools
+import itertools
+import yt_dlp
+from yt_dlp.utils import download_range_func, parse_duration
 
+# Shared session for metadata lookups: reuses extractor setup and TLS
+# connections across the batch instead of forking a yt-dlp process per URL
+_METADATA_OPTS = {"quiet": True, "no_warnings": True, "skip_download": True}
+_metadata_ydl = None
+
+def _get_metadata_ydl():
+    global _metadata_ydl
+    if _metadata_ydl is None:
+        _metadata_ydl = yt_dlp.YoutubeDL(_METADATA_OPTS)
+    return _metadata_ydl
+
+# Per-directory index counters: the directory is scanned once with
+# os.scandir and later downloads just increment in memory
+_index_counters = {}
+
+def _next_file_index(output_dir):
+    """Conta os arquivos video_* existentes uma única vez e incrementa em memória."""
+    counter = _index_counters.get(output_dir)
+    if counter is None:
+        os.makedirs(output_dir, exist_ok=True)
+        existing = sum(1 for entry in os.scandir(output_dir) if entry.name.startswith("video_"))
+        counter = itertools.count(existing + 1)
+        _index_counters[output_dir] = counter
+    return next(counter)
+
+@functools.lru_cache(maxsize=1024)
 def get_video_metadata(video_url):
     """
-    Uses yt-dlp to retrieve metadata such as video ID.
+    Uses the in-process yt-dlp API to retrieve metadata such as video ID.
     If metadata extraction fails, generates a fallback unique ID.
+
+    Results are memoized per URL, so repeated lookups within a session
+    (e.g., different segments of the same video) hit the network once.
     """
     try:
-        result = subprocess.run(
-            ["yt-dlp", "--print-json", "--skip-download", video_url],
-            capture_output=True, text=True, check=True
-        )
-        metadata = json.loads(result.stdout)
-        video_id = metadata.get("id", str(uuid.uuid4().hex[:6]))  # Use video ID or fallback
-        return video_id
+        # process=False pula a resolução de formatos — só o necessário para o ID
+        info = _get_metadata_ydl().extract_info(video_url, download=False, process=False)
+        return info.get("id") or str(uuid.uuid4().hex[:6])  # Use video ID or fallback
     except Exception:
         return str(uuid.uuid4().hex[:6])  # Generate unique ID if metadata retrieval fails
 
 def download_youtube_audio(video_url, output_dir="./data/raw", start_time=None, end_time=None, processed_urls=set(), index=None):
     """
-    Downloads a specific segment of audio from a YouTube video using yt-dlp and converts it to WAV format.
+    Downloads a specific segment of audio from a YouTube video using the
+    in-process yt-dlp API and converts it to WAV format.
     Ensures unique filenames and avoids reprocessing duplicate URLs.
 
     Parameters:
@@ -39,13 +67,12 @@ def download_youtube_audio(video_url, output_dir="./data/raw", start_time=None,
         print(f"[INFO] Skipping duplicate video: {video_url}")
         return None
 
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
-    
-    # Determine index based on existing files if not provided
+    # Determine index from the cached per-directory counter if not provided
+    # (also creates output_dir on the first call)
     if index is None:
-        existing_files = [f for f in os.listdir(output_dir) if f.startswith("video_")]
-        index = len(existing_files) + 1
+        index = _next_file_index(output_dir)
+    else:
+        os.makedirs(output_dir, exist_ok=True)
 
     try:
         if index == 1:
@@ -60,23 +87,72 @@ def download_youtube_audio(video_url, output_dir="./data/raw", start_time=None,
 
         print(f"[INFO] Processing file {index}...")
 
+        # yt-dlp baixa bestaudio e o postprocessor converte para WAV
+        ydl_opts = {
+            "format": "bestaudio",
+            "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "wav"}],
+            "outtmpl": output_path.replace(".wav", ".%(ext)s"),
+        }
+
         # Define a seção a ser baixada, se os tempos foram fornecidos
-        yt_dlp_command = [
-            "yt-dlp", "-f", "bestaudio", "--extract-audio", "--audio-format", "wav",
-            "-o", output_path, video_url
-        ]
-        
         if start_time and end_time:
-            yt_dlp_command.insert(1, "--download-sections")
-            yt_dlp_command.insert(2, f"*{start_time}-{end_time}")
+            ydl_opts["download_ranges"] = download_range_func(
+                None, [(parse_duration(start_time), parse_duration(end_time))]
+            )
 
-        # Executa o comando corretamente formatado
-        subprocess.run(yt_dlp_command, check=True)
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            ydl.extract_info(video_url, download=True)
 
         print(f"[SUCCESS] File {index} processed successfully: {output_path}")
         processed_urls.add(video_url)
         return output_path
 
-    except subprocess.CalledProcessError as e:
+    except yt_dlp.utils.DownloadError as e:
         print(f"[ERROR] Failed to process file {index}: {e}")
         return None
+
+def download_youtube_audio_batch(video_urls, output_dir="./data/raw"):
+    """
+    Downloads audio from a batch of YouTube URLs in a single yt-dlp session.
+
+    One YoutubeDL instance amortizes extractor setup and connection reuse
+    over the whole batch, filenames come from the autonumber/id template
+    instead of rescanning the directory per file, and concurrent fragment
+    downloads keep the link saturated.
+
+    Parameters:
+    - video_urls (list): YouTube video URLs, duplicates are skipped.
+    - output_dir (str): Directory where the audio files will be saved.
+
+    Returns:
+    - list: Paths to the extracted WAV files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    ydl_opts = {
+        "format": "bestaudio",
+        "postprocessors": [{"key": "FFmpegExtractAudio", "preferredcodec": "wav"}],
+        "outtmpl": os.path.join(output_dir, "video_%(autonumber)02d_%(id)s.%(ext)s"),
+        "concurrent_fragment_downloads": 4,
+    }
+
+    output_paths = []
+    seen_urls = set()
+
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        for video_url in video_urls:
+            if video_url in seen_urls:
+                print(f"[INFO] Skipping duplicate video: {video_url}")
+                continue
+            seen_urls.add(video_url)
+
+            try:
+                info = ydl.extract_info(video_url, download=True)
+                # O postprocessor troca a extensão original por .wav
+                output_path = os.path.splitext(ydl.prepare_filename(info))[0] + ".wav"
+                output_paths.append(output_path)
+                print(f"[SUCCESS] Downloaded: {output_path}")
+            except yt_dlp.utils.DownloadError as e:
+                print(f"[ERROR] Failed to download {video_url}: {e}")
+
+    return output_paths